@@ -0,0 +1,196 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Keep note parsing helpers used by keep_to_supabase.py.
+
+Plain Python that Cython can also compile as-is. Build the optional
+extension in this directory with:
+
+    cythonize -i keep_parse.py
+
+Python picks up the compiled module over this file when it exists.
+"""
+import re
+import functools
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+try:
+    # google-re2 matches in linear time with no backtracking. Patterns compiled
+    # with it must match identically under re, e.g. [0-9] rather than \d
+    import re2 as chord_re
+except ImportError:
+    chord_re = re
+
+TAB_LINE_RE = re.compile(r"^\s*[eEGBDA]\s*\|")
+BRACKET_CONTENT_RE = re.compile(r"\((.*?)\)")
+WHITESPACE_RE = re.compile(r"\s+")
+CHORD_SEPARATOR_RE = re.compile(r"[,\s]+")
+
+NOTES_SHARP = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+NOTES_FLAT = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+ALL_NOTES = NOTES_SHARP + NOTES_FLAT
+CHORD_SUFFIX_RE = chord_re.compile(r'^(?:' + '|'.join(ALL_NOTES) + r')(?:m|maj|min|dim|aug|sus|[0-9]+)?(?:/[A-G][b#]?)?$')
+
+# Lone CRs become newlines and dashes are normalised, after CRLF is folded
+TEXT_TRANS = str.maketrans({"\r": "\n", "–": "-", "—": "-"})
+
+
+def civil_from_days(days: int) -> Tuple[int, int, int]:
+    # Howard Hinnant's days_from_civil inverse; days are counted from 1970-01-01
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (month <= 2), month, day
+
+
+def micros_to_iso(micros: Optional[int]) -> Optional[str]:
+    # Same text as datetime.fromtimestamp(..., tz=timezone.utc).isoformat()
+    # without building a datetime per call
+    if micros is None:
+        return None
+    secs, us = divmod(micros, 1_000_000)
+    days, secs = divmod(secs, 86400)
+    hour, secs = divmod(secs, 3600)
+    minute, sec = divmod(secs, 60)
+    year, month, day = civil_from_days(days)
+    if us:
+        return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{sec:02d}.{us:06d}+00:00"
+    return f"{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{sec:02d}+00:00"
+
+
+# COPY text format escapes, plus the dash normalisation applied to all text
+COPY_TEXT_TRANS = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "–": "-", "—": "-"})
+
+
+def escape_copy_value(s: Optional[str]) -> str:
+    if s is None:
+        return "\\N"
+    return s.translate(COPY_TEXT_TRANS)
+
+
+def is_url_only(line: str) -> bool:
+    # Same as matching r"https?://\S+" against an already stripped line
+    if line.startswith("https://"):
+        rest = line[8:]
+    elif line.startswith("http://"):
+        rest = line[7:]
+    else:
+        return False
+    return rest.split(None, 1) == [rest]
+
+
+@functools.lru_cache(maxsize=4096)
+def extract_chords_from_title(title: str) -> Tuple[str, Optional[str]]:
+    title = WHITESPACE_RE.sub(' ', title).strip()
+    metadata_chords = None
+    match = BRACKET_CONTENT_RE.search(title)
+    if match:
+        bracket_content = match.group(1)
+        tokens = [t.strip() for t in CHORD_SEPARATOR_RE.split(bracket_content) if t.strip()]
+        valid_chords = [t for t in tokens if CHORD_SUFFIX_RE.match(t)]
+        if valid_chords:
+            metadata_chords = f"Chords used : {', '.join(valid_chords)}"
+            title = title[:match.start()].strip() + title[match.end():].strip()
+            title = WHITESPACE_RE.sub(' ', title).strip()
+    return title, metadata_chords
+
+
+def parse_note_json(data: Dict) -> Dict:
+    # --- Extract chords from title and update metadata ---
+    title_raw = (data.get("title", "") or "").strip()
+    title, metadata_chords = extract_chords_from_title(title_raw)
+
+    # --- Normalize and clean text content ---
+    raw_text = (data.get("textContent", "") or "").replace("\r\n", "\n").translate(TEXT_TRANS)
+
+    # --- Extract labels/tags ---
+    labels = [l.get("name", "").strip() for l in data.get("labels", []) if l.get("name")]
+
+    # --- Split text into lines ---
+    lines = raw_text.split("\n")
+
+    # --- Single pass: references, metadata paragraph and grouped content ---
+    # URLs alone on a line become references wherever they appear. The first
+    # paragraph is metadata unless it starts with a number or has a tab line,
+    # so it is held back until its closing blank line (or the end of the note).
+    references_lines = []
+    metadata_lines = []
+    grouped_content = []
+    current_tab_block = []
+    first_paragraph = []
+    first_paragraph_has_tab = False
+    state = "first_paragraph"
+
+    # --- Group guitar tab lines into code blocks ---
+    def flush_tab_block():
+        if current_tab_block:
+            grouped_content.append("```" + "\n".join(current_tab_block) + "\n```")
+            current_tab_block.clear()
+
+    def add_content(line: str, is_tab: bool):
+        if is_tab:
+            current_tab_block.append(line)
+        else:
+            flush_tab_block()
+            grouped_content.append(line)
+
+    def close_first_paragraph() -> bool:
+        if first_paragraph and (first_paragraph_has_tab or first_paragraph[0].lstrip()[:1].isdecimal()):
+            for line in first_paragraph:
+                add_content(line, TAB_LINE_RE.match(line) is not None)
+            return False
+        metadata_lines.extend(first_paragraph)
+        return True
+
+    for line in lines:
+        stripped = line.strip()
+        if is_url_only(stripped):
+            references_lines.append(stripped)
+            continue
+        is_tab = TAB_LINE_RE.match(line) is not None
+        if state == "first_paragraph":
+            if stripped:
+                first_paragraph.append(line)
+                first_paragraph_has_tab = first_paragraph_has_tab or is_tab
+                continue
+            state = "content"
+            if close_first_paragraph():
+                # The blank line separating metadata from content is dropped
+                continue
+        add_content(line, is_tab)
+
+    if state == "first_paragraph":
+        close_first_paragraph()
+    flush_tab_block()
+
+    references = "\n".join(references_lines)
+
+    # --- Merge metadata lines and extracted chords ---
+    metadata_text = "\n".join(metadata_lines).strip()
+    if metadata_chords:
+        if metadata_text:
+            metadata_text += "\n" + metadata_chords
+        else:
+            metadata_text = metadata_chords
+
+    # --- Prepare content field ---
+    content = "\n".join(grouped_content).strip()
+
+    # --- Convert timestamps ---
+    created_iso = micros_to_iso(int(data.get("createdTimestampUsec", 0))) or datetime.now(timezone.utc).isoformat()
+    updated_iso = micros_to_iso(int(data.get("userEditedTimestampUsec", 0))) or created_iso
+
+    return {
+        "title": title,
+        "metadata": metadata_text,
+        "content": content,
+        "references": references,
+        "labels": labels,
+        "is_pinned": bool(data.get("isPinned", False)),
+        "created_at_iso": created_iso,
+        "updated_at_iso": updated_iso,
+    }
@@ -1,15 +1,27 @@
 import json
 import os
-import re
 import uuid
 import time
 import logging
 import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from datetime import datetime, timezone
 from typing import List, Dict, Optional, Set, Tuple
 
+import ijson
 import requests
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from keep_parse import escape_copy_value, parse_note_json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ===================== USER CONFIG =====================
 USER_ID = "<SUPABASE_USER_ID>"  # Supabase auth.users UUID
@@ -17,18 +29,18 @@ INPUT_DIR = Path(".")
 OUTPUT_SQL = Path("output.sql")
 OUTPUT_METADATA = Path("metadata.json")
 LOG_FILE = Path("convert_keep_notes.log")
+MB_CACHE_DIR = Path(".mb_cache")
 # =======================================================
 
-URL_RE = re.compile(r"(https?://[^\s]+)")
-TAB_LINE_RE = re.compile(r"^\s*[eEGBDA]\s*\|")
-BLANK_LINE_RE = re.compile(r"^\s*$")
-STARTS_WITH_NUMBER_RE = re.compile(r"^\s*\d")
-BRACKET_CONTENT_RE = re.compile(r"\((.*?)\)")
-
-NOTES_SHARP = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-NOTES_FLAT = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
-ALL_NOTES = NOTES_SHARP + NOTES_FLAT
-CHORD_SUFFIX_RE = re.compile(r'^(?:' + '|'.join(ALL_NOTES) + r')(?:m|maj|min|dim|aug|sus|\d+)?(?:/[A-G][b#]?)?$')
+# Top-level Keep export fields read by parse_note_json
+KEEP_NOTE_FIELDS = frozenset({
+    "title",
+    "textContent",
+    "labels",
+    "isPinned",
+    "createdTimestampUsec",
+    "userEditedTimestampUsec",
+})
 
 logging.basicConfig(
     level=logging.INFO,
@@ -40,124 +52,37 @@ logging.basicConfig(
 )
 
 
-def micros_to_iso(micros: Optional[int]) -> Optional[str]:
-    if micros is None:
-        return None
-    ts = micros / 1_000_000.0
-    dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-    return dt.isoformat()
-
-
-def escape_sql_string(s: Optional[str]) -> str:
-    if s is None:
-        return "NULL"
-    s = s.replace("–", "-").replace("—", "-")
-    s = s.replace("'", "''")
-    return f"'{s}'"
-
-
-def extract_chords_from_title(title: str) -> Tuple[str, Optional[str]]:
-    title = re.sub(r'\s+', ' ', title).strip()
-    metadata_chords = None
-    match = BRACKET_CONTENT_RE.search(title)
-    if match:
-        bracket_content = match.group(1)
-        tokens = [t.strip() for t in re.split(r'[,\s]+', bracket_content) if t.strip()]
-        valid_chords = [t for t in tokens if CHORD_SUFFIX_RE.match(t)]
-        if valid_chords:
-            metadata_chords = f"Chords used : {', '.join(valid_chords)}"
-            title = title[:match.start()].strip() + title[match.end():].strip()
-            title = re.sub(r'\s+', ' ', title).strip()
-    return title, metadata_chords
-
-
-def parse_note_json(data: Dict) -> Dict:
-    # --- Extract chords from title and update metadata ---
-    title_raw = (data.get("title", "") or "").strip()
-    title, metadata_chords = extract_chords_from_title(title_raw)
-
-    # --- Normalize and clean text content ---
-    raw_text = (data.get("textContent", "") or "").replace("–", "-").replace("—", "-")
-
-    # --- Extract labels/tags ---
-    labels = [l.get("name", "").strip() for l in data.get("labels", []) if l.get("name")]
-
-    # --- Split text into lines ---
-    lines = raw_text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
-
-    # --- Extract references (URLs that are on a line alone) ---
-    references_lines = []
-    content_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if URL_RE.fullmatch(stripped):
-            references_lines.append(stripped)
-        else:
-            content_lines.append(line)
-    references = "\n".join(references_lines)
-
-    # --- Determine if first paragraph should be treated as metadata ---
-    first_paragraph = []
-    for line in content_lines:
-        if BLANK_LINE_RE.match(line):
-            break
-        first_paragraph.append(line)
-
-    use_metadata = True
-    if first_paragraph:
-        tab_lines_count = sum(1 for l in first_paragraph if TAB_LINE_RE.match(l))
-        if STARTS_WITH_NUMBER_RE.match(first_paragraph[0]) or tab_lines_count > 0:
-            use_metadata = False
-
-    # --- Extract metadata lines ---
-    metadata_lines = []
-    i = 0
-    if use_metadata:
-        while i < len(content_lines) and not BLANK_LINE_RE.match(content_lines[i]):
-            metadata_lines.append(content_lines[i])
-            i += 1
-        content_lines = content_lines[i + 1 :]
-
-    # --- Group guitar tab lines into code blocks ---
-    grouped_content = []
-    j = 0
-    while j < len(content_lines):
-        if TAB_LINE_RE.match(content_lines[j]):
-            block = []
-            while j < len(content_lines) and TAB_LINE_RE.match(content_lines[j]):
-                block.append(content_lines[j])
-                j += 1
-            grouped_content.append("```" + "\n".join(block) + "\n```")
-        else:
-            grouped_content.append(content_lines[j])
-            j += 1
-
-    # --- Merge metadata lines and extracted chords ---
-    metadata_text = "\n".join(metadata_lines).strip()
-    if metadata_chords:
-        if metadata_text:
-            metadata_text += "\n" + metadata_chords
-        else:
-            metadata_text = metadata_chords
-
-    # --- Prepare content field ---
-    content = "\n".join(grouped_content).strip()
-    content = "\n".join([line for line in content.split("\n")]).strip("\n")
+def load_json(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
 
-    # --- Convert timestamps ---
-    created_iso = micros_to_iso(int(data.get("createdTimestampUsec", 0))) or datetime.now(timezone.utc).isoformat()
-    updated_iso = micros_to_iso(int(data.get("userEditedTimestampUsec", 0))) or created_iso
 
-    return {
-        "title": title,
-        "metadata": metadata_text,
-        "content": content,
-        "references": references,
-        "labels": labels,
-        "is_pinned": bool(data.get("isPinned", False)),
-        "created_at_iso": created_iso,
-        "updated_at_iso": updated_iso,
-    }
+def save_json(path: Path, obj):
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with path.open("w", encoding="utf-8") as fh:
+            json.dump(obj, fh, indent=2, ensure_ascii=False)
+
+
+def load_keep_note(path: str) -> Dict:
+    # Stream the top-level pairs so unused fields (annotations, attachments,
+    # sharees, ...) are dropped one at a time instead of held as a full tree
+    with open(path, "rb") as fh:
+        # kvitems yields nothing for a non-object document, which would
+        # otherwise come out as a blank note. Peek at the first token rather
+        # than pulling every parse event through Python.
+        head = b""
+        while not head:
+            chunk = fh.read(256)
+            if not chunk:
+                break
+            head = chunk.lstrip(b" \t\r\n")
+        if head[:1] != b"{":
+            raise ValueError("top-level JSON value is not an object")
+        fh.seek(0)
+        return {key: value for key, value in ijson.kvitems(fh, "") if key in KEEP_NOTE_FIELDS}
 
 
 # --- MusicBrainz ---
@@ -165,104 +90,244 @@ MB_ENDPOINT = "https://musicbrainz.org/ws/2/recording/"
 USER_AGENT = "KeepNotesToSupabase/1.0 ( your_email@example.com )"
 
 
-def fetch_artist_album(title: str) -> Tuple[Optional[str], Optional[str], Optional[int]]:
-    params = {"query": title, "fmt": "json"}
+MB_CACHE_EXPIRE = 30 * 86400  # seconds to keep a successful lookup
+MB_CACHE_EXPIRE_MISS = 86400  # shorter so transient failures get retried
+MB_MIN_INTERVAL = 1.0  # MusicBrainz allows ~1 request/second per client
+MB_MAX_WORKERS = 8
+MB_MAX_QUERY_LENGTH = 200  # keeps pathological titles from overflowing the URL
+MB_MAX_ATTEMPTS = 4  # first try plus retries on throttling/server errors
+MB_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class RateLimiter:
+    """Spaces out calls to wait() across threads by at least `interval` seconds."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._blocked_until = 0.0
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                slot = max(now, self._next_slot, self._blocked_until)
+                self._next_slot = slot + self.interval
+            delay = slot - now
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                # A defer() while we slept moves us behind the block
+                if self._blocked_until <= slot:
+                    return
+
+    def defer(self, delay: float):
+        """Hold every thread, including ones already waiting, for `delay` seconds."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+
+_mb_rate_limiter = RateLimiter(MB_MIN_INTERVAL)
+
+# One keep-alive session for all lookups. urllib3 only retries failed
+# connections, which never reached the server; 429/5xx responses are retried
+# in fetch_artist_album so every attempt takes its own rate-limiter slot.
+MB_SESSION = requests.Session()
+MB_SESSION.headers["User-Agent"] = USER_AGENT
+MB_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MB_MAX_WORKERS,
+        max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.3),
+    ),
+)
+
+
+def retry_after_seconds(resp: requests.Response) -> float:
+    value = resp.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else 0.0
+
+
+def normalize_title(title: str) -> str:
+    return title.strip().lower()
+
+
+def fetch_artist_album(title: str, cache: Cache) -> Tuple[Optional[str], Optional[str], Optional[int]]:
+    key = normalize_title(title)
+    cached = cache.get(key)
+    if cached is not None:
+        return tuple(cached)
+
+    # Only the top recording is used, so skip the default 25 results
+    params = {"query": title[:MB_MAX_QUERY_LENGTH], "fmt": "json", "limit": 1}
     try:
-        resp = requests.get(MB_ENDPOINT, params=params, headers={"User-Agent": USER_AGENT}, timeout=8)
-        if resp.status_code != 200:
-            return (None, None, None)
-        data = resp.json()
-        recordings = data.get("recordings", [])
-        if not recordings:
+        for _ in range(MB_MAX_ATTEMPTS):
+            # Only real requests count against the MusicBrainz rate limit,
+            # and each retry is a real request
+            _mb_rate_limiter.wait()
+            resp = MB_SESSION.get(MB_ENDPOINT, params=params, timeout=8)
+            if resp.status_code not in MB_RETRY_STATUSES:
+                break
+            # MusicBrainz answers 503 when it is throttling; back off all workers
+            _mb_rate_limiter.defer(retry_after_seconds(resp))
+        else:
+            # Still throttled or failing: not cached, like a network error
             return (None, None, None)
-        rec = recordings[0]
-        artist = rec["artist-credit"][0]["name"] if "artist-credit" in rec else None
-        album = rec["releases"][0]["title"] if rec.get("releases") else None
-        release_year = None
-        if rec.get("releases") and rec["releases"][0].get("date"):
-            try:
-                release_year = int(rec["releases"][0]["date"].split("-")[0])
-            except Exception:
+
+        if resp.status_code != 200:
+            result = (None, None, None)
+        else:
+            data = resp.json()
+            recordings = data.get("recordings", [])
+            if not recordings:
+                result = (None, None, None)
+            else:
+                rec = recordings[0]
+                artist = rec["artist-credit"][0]["name"] if "artist-credit" in rec else None
+                album = rec["releases"][0]["title"] if rec.get("releases") else None
                 release_year = None
-        return artist, album, release_year
+                if rec.get("releases") and rec["releases"][0].get("date"):
+                    try:
+                        release_year = int(rec["releases"][0]["date"].split("-")[0])
+                    except Exception:
+                        release_year = None
+                result = (artist, album, release_year)
     except Exception:
+        # Network errors are not cached so the next run tries again
         return (None, None, None)
-    finally:
-        time.sleep(1.0)
+
+    expire = MB_CACHE_EXPIRE if result != (None, None, None) else MB_CACHE_EXPIRE_MISS
+    cache.set(key, result, expire=expire)
+    return result
 
 
 # --- Main conversion ---
+COLLECT_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def read_and_parse_note(path: str) -> Optional[Dict]:
+    try:
+        data = load_keep_note(path)
+    except Exception as e:
+        logging.error(f"Skipping {os.path.basename(path)}: {e}")
+        return None
+    return parse_note_json(data)
+
+
 def collect_notes(input_dir: Path) -> List[Dict]:
-    notes = []
-    for f in input_dir.glob("*.json"):
-        try:
-            with f.open("r", encoding="utf-8") as fh:
-                data = json.load(fh)
-        except Exception as e:
-            logging.error(f"Skipping {f.name}: {e}")
-            continue
-        parsed = parse_note_json(data)
-        notes.append(parsed)
-    return notes
+    # scandir reuses the directory listing's file type, so no stat per entry
+    with os.scandir(input_dir) as it:
+        # Our own metadata.json may sit in the input directory from an earlier run
+        paths = [
+            e.path
+            for e in it
+            if e.name.endswith(".json") and e.name != OUTPUT_METADATA.name and e.is_file()
+        ]
+    # File reads release the GIL, so threads overlap the open/read latency
+    with ThreadPoolExecutor(max_workers=COLLECT_MAX_WORKERS) as executor:
+        parsed = executor.map(read_and_parse_note, paths)
+        return [n for n in parsed if n is not None]
 
 
 def fetch_and_save_metadata(notes: List[Dict]):
+    # Notes sharing a title (capo/tuning variants, covers) need only one lookup
+    groups: Dict[str, List[Dict]] = defaultdict(list)
     for n in notes:
         if n["title"]:
-            artist, album, release_year = fetch_artist_album(n["title"])
-            n["artist"] = artist
-            n["album"] = album
-            n["release_year"] = release_year
-            logging.info(f"Fetched for '{n['title']}': artist={artist}, album={album}, year={release_year}")
-    with OUTPUT_METADATA.open("w", encoding="utf-8") as fh:
-        json.dump(notes, fh, indent=2, ensure_ascii=False)
+            groups[normalize_title(n["title"])].append(n)
+
+    # Opened here rather than at import so `sql` runs don't create .mb_cache/
+    with Cache(str(MB_CACHE_DIR)) as cache, ThreadPoolExecutor(max_workers=MB_MAX_WORKERS) as executor:
+        futures = {executor.submit(fetch_artist_album, group[0]["title"], cache): group for group in groups.values()}
+        for future in as_completed(futures):
+            group = futures[future]
+            artist, album, release_year = future.result()
+            for n in group:
+                n["artist"] = artist
+                n["album"] = album
+                n["release_year"] = release_year
+            logging.info(
+                f"Fetched for '{group[0]['title']}' ({len(group)} notes): artist={artist}, album={album}, year={release_year}"
+            )
+    save_json(OUTPUT_METADATA, notes)
     logging.info(f"Saved metadata to {OUTPUT_METADATA}")
 
 
+def bulk_uuids(count: int) -> List[str]:
+    # One urandom read for the whole batch; version=4 sets the same
+    # version/variant bits uuid.uuid4() would
+    buf = os.urandom(16 * count)
+    return [str(uuid.UUID(bytes=buf[i : i + 16], version=4)) for i in range(0, 16 * count, 16)]
+
+
 def generate_sql(notes: List[Dict], user_id: str):
     all_tags: Set[str] = set()
     for n in notes:
         all_tags.update(n["labels"])
 
-    tag_map = {t: str(uuid.uuid4()) for t in sorted(all_tags)}
-    note_ids = [str(uuid.uuid4()) for _ in notes]
-
-    with OUTPUT_SQL.open("w", encoding="utf-8") as out:
-        out.write("-- SQL statements generated from Keep JSON export\n")
-
-        for name, tid in tag_map.items():
-            out.write(
-                f"INSERT INTO public.tags (id, user_id, name) VALUES ('{tid}', '{user_id}', {escape_sql_string(name)});\n"
-            )
-
-        for idx, n in enumerate(notes):
-            nid = note_ids[idx]
-            out.write(
-                "INSERT INTO public.notes (id, user_id, title, content, artist, album, release_year, metadata, \"references\", is_pinned, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);\n"
-                % (
-                    f"'{nid}'",
-                    f"'{user_id}'",
-                    escape_sql_string(n["title"]),
-                    escape_sql_string(n["content"]),
-                    escape_sql_string(n.get("artist")) if n.get("artist") else "NULL",
-                    escape_sql_string(n.get("album")) if n.get("album") else "NULL",
-                    str(n.get("release_year")) if n.get("release_year") else "NULL",
-                    escape_sql_string(n["metadata"]) if n["metadata"] else "NULL",
-                    escape_sql_string(n["references"]) if n["references"] else "NULL",
-                    "TRUE" if n["is_pinned"] else "FALSE",
-                    f"'{n['created_at_iso']}'",
-                    f"'{n['updated_at_iso']}'",
-                )
-            )
-
-            for label in n["labels"]:
-                if label in tag_map:
-                    ntid = str(uuid.uuid4())
-                    out.write(
-                        f"INSERT INTO public.note_tags (id, user_id, note_id, tag_id) VALUES ('{ntid}', '{user_id}', '{nid}', '{tag_map[label]}');\n"
-                    )
-
-    logging.info(f"Wrote SQL to {OUTPUT_SQL}")
+    sorted_tags = sorted(all_tags)
+    tag_map = dict(zip(sorted_tags, bulk_uuids(len(sorted_tags))))
+    note_ids = bulk_uuids(len(notes))
+    note_tag_ids = iter(bulk_uuids(sum(len(n["labels"]) for n in notes)))
+
+    parts = [
+        "-- SQL statements generated from Keep JSON export\n",
+        # COPY ... FROM STDIN is a psql feature
+        f"-- Load with: psql <connection string> -f {OUTPUT_SQL.name} (the Supabase SQL editor cannot run COPY FROM STDIN)\n",
+    ]
+
+    parts.append("COPY public.tags (id, user_id, name) FROM STDIN;\n")
+    for name, tid in tag_map.items():
+        parts.append(f"{tid}\t{user_id}\t{escape_copy_value(name)}\n")
+    parts.append("\\.\n")
+
+    # Build each column in one pass over the notes, then join rows column-wise
+    parts.append(
+        "COPY public.notes (id, user_id, title, content, artist, album, release_year, metadata, \"references\", is_pinned, created_at, updated_at) FROM STDIN;\n"
+    )
+    columns = (
+        note_ids,
+        [user_id] * len(notes),
+        [escape_copy_value(n["title"]) for n in notes],
+        [escape_copy_value(n["content"]) for n in notes],
+        # Empty strings are stored as NULL, like missing values
+        [escape_copy_value(n.get("artist") or None) for n in notes],
+        [escape_copy_value(n.get("album") or None) for n in notes],
+        [str(n.get("release_year") or "\\N") for n in notes],
+        [escape_copy_value(n["metadata"] or None) for n in notes],
+        [escape_copy_value(n["references"] or None) for n in notes],
+        ["true" if n["is_pinned"] else "false" for n in notes],
+        [n["created_at_iso"] for n in notes],
+        [n["updated_at_iso"] for n in notes],
+    )
+    parts.extend(f"{row}\n" for row in map("\t".join, zip(*columns)))
+    parts.append("\\.\n")
+
+    # note_tags reference notes, so they are loaded after every note
+    parts.append("COPY public.note_tags (id, user_id, note_id, tag_id) FROM STDIN;\n")
+    for nid, n in zip(note_ids, notes):
+        for label in n["labels"]:
+            if label in tag_map:
+                ntid = next(note_tag_ids)
+                parts.append(f"{ntid}\t{user_id}\t{nid}\t{tag_map[label]}\n")
+    parts.append("\\.\n")
+
+    # Build the whole script in memory and hand it to the file in one write
+    with open(OUTPUT_SQL, "w", encoding="utf-8", buffering=1 << 20) as out:
+        out.write("".join(parts))
+
+    logging.info(
+        f"Wrote SQL to {OUTPUT_SQL}. Load it with `psql <connection string> -f {OUTPUT_SQL}`; "
+        "the COPY ... FROM STDIN blocks will not run in the Supabase SQL editor."
+    )
+
+
+USAGE = f"""Usage: python script.py [fetch|sql]
+  fetch  parse the Keep exports and write {OUTPUT_METADATA} (artist/album from MusicBrainz)
+  sql    write {OUTPUT_SQL} from {OUTPUT_METADATA}; load it with
+         `psql <connection string> -f {OUTPUT_SQL}` (not the Supabase SQL editor)"""
 
 
 if __name__ == "__main__":
@@ -271,7 +336,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if len(sys.argv) < 2:
-        print("Usage: python script.py [fetch|sql]")
+        print(USAGE)
         sys.exit(0)
 
     mode = sys.argv[1]
@@ -282,8 +347,7 @@ if __name__ == "__main__":
         if not OUTPUT_METADATA.exists():
             logging.error("metadata.json not found. Run with 'fetch' first.")
             sys.exit(1)
-        with OUTPUT_METADATA.open("r", encoding="utf-8") as fh:
-            notes = json.load(fh)
+        notes = load_json(OUTPUT_METADATA.read_bytes())
         generate_sql(notes, USER_ID)
     else:
-        print("Usage: python script.py [fetch|sql]")
+        print(USAGE)